@@ -1,8 +1,34 @@
 from __future__ import annotations  # Needed for nice future-typing
+import heapq
+import itertools
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing.util import Finalize
 from typing import Any
 from problem import Problem
 from column_generation import ColumnGenerationSolver
 
+# Column generation solver of a worker process (only used when solving in parallel)
+_worker_cg_solver: ColumnGenerationSolver | None = None
+
+
+def _init_worker(problem: Problem):
+    """
+    Initialises a worker process with its own column generation solver.
+    The solver is closed when the worker exits.
+    """
+    global _worker_cg_solver
+    _worker_cg_solver = ColumnGenerationSolver(problem)
+    # Worker processes may exit without running `atexit` handlers,
+    # but always run multiprocessing finalizers
+    Finalize(_worker_cg_solver, _worker_cg_solver.close, exitpriority=0)
+
+
+def _solve_fixings(fixings: tuple) -> tuple[float, Any]:
+    """
+    Solves a node in a worker process, given the fixings of the node.
+    """
+    return _worker_cg_solver.solve(fixings)
+
 
 class Solution:
     """
@@ -28,11 +54,23 @@ class Node:
 
     Contains a `_cg_solver` (the column generation solver for the node),
     a `parent_node`, and a fixed variable.
-    Then, calling `get_fixed_vars()` to get a list of variable fixings from
-    this and all parent nodes.
+    The fixings of this and all parent nodes are kept as a tuple, built once
+    when the variable is fixed. Call `get_fixed_vars()` to get them as a list.
     `solve` calls the column generation solver with the given variable fixings.
     """
 
+    # Trees can have very many nodes, so avoid a `__dict__` per node.
+    # Any attributes added for an application (e.g. in `add_fixed_var`)
+    # must also be added here
+    __slots__ = (
+        "_parent_node",
+        "_cg_solver",
+        "_fixed_var",
+        "_fixings",
+        "_depth",
+        "_bound",
+    )
+
     def __init__(self, parent_node: Node | None) -> None:
         """
         Constructor not to be called directly!
@@ -40,33 +78,69 @@ class Node:
         """
         # Parent node (None if root node)
         self._parent_node = parent_node
-        # Reference to the root problem
-        if isinstance(parent_node, Node):
-            self._cg_solver: ColumnGenerationSolver = parent_node._cg_solver
+        # Reference to the column generation solver of the tree
+        # (None when nodes are solved by worker processes instead)
+        self._cg_solver: ColumnGenerationSolver | None = (
+            parent_node._cg_solver if isinstance(parent_node, Node) else None
+        )
         # The fixed variable at this node
         self._fixed_var: tuple = None
+        # All fixed variables from the root down to this node.
+        # Built once on construction, since fixings only ever append down a branch
+        self._fixings: tuple = () if parent_node is None else parent_node._fixings
+        # Depth of this node in the tree (root node is depth 0)
+        self._depth: int = 0 if parent_node is None else parent_node._depth + 1
+        # Best known bound of this node.
+        # Initially the parent's bound, then replaced once the node is solved
+        self._bound: float | None = None if parent_node is None else parent_node._bound
 
     def add_fixed_var(self, var, val):
         """
         Add a fixed variable to this node.
         Fixes `var` to `val`.
         Specific notation/implementation should depend on application.
+        `(var, val)` should be hashable (e.g. a tuple, not a list) for the solve
+        to be cached (see `ColumnGenerationSolver.SOLVE_CACHE_SIZE`).
         """
         self._fixed_var = (var, val)
+        if self._parent_node is None:
+            self._fixings = (self._fixed_var,)
+        else:
+            self._fixings = self._parent_node._fixings + (self._fixed_var,)
 
     def get_fixed_vars(self) -> list[tuple]:
         """
         Returns a list of all fixed values at a node.
-        Recursively calls the parents fixed variable, and its parents, etc.etc.
-        Terminates at the root node.
+        These are the fixings of this node and all its parents, ordered from
+        the root down to this node.
         """
-        if self._parent_node is None:
-            if self._fixed_var is None:
-                return []
-            else:
-                return [self._fixed_var]
-        else:
-            return [self._fixed_var] + self._parent_node.get_fixed_vars()
+        return list(self._fixings)
+
+    def get_fixings(self) -> tuple[tuple]:
+        """
+        Returns the fixings of this node and all its parents, as the tuple that
+        is passed to the column generation solver (e.g. to solve in another process).
+        """
+        return self._fixings
+
+    def get_depth(self) -> int:
+        """
+        Returns the depth of this node in the tree (root node is depth 0).
+        """
+        return self._depth
+
+    def get_bound(self) -> float | None:
+        """
+        Returns the best known bound of this node.
+        The parent's bound until this node is solved (None for an unsolved root node).
+        """
+        return self._bound
+
+    def set_bound(self, bound: float | None):
+        """
+        Sets the bound of this node, once solved (None if infeasible).
+        """
+        self._bound = bound
 
     def solve(self) -> tuple[float, Any]:
         """
@@ -75,10 +149,12 @@ class Node:
         The partial solution is anything required to either
          1. Repair solution to get a new incumbent, or
          2. Make branching decisions off.
+        Only used when solving serially, otherwise the fixings are solved by a
+        worker process (see `BranchAndPriceSolver._solve_parallel`).
         """
-        return self._cg_solver.solve(self.get_fixed_vars())
+        return self._cg_solver.solve(self._fixings)
 
-    def _set_cg_solver(self, cg_solver: ColumnGenerationSolver):
+    def _set_cg_solver(self, cg_solver: ColumnGenerationSolver | None):
         """
         Sets the column generation solver
         """
@@ -92,13 +168,16 @@ class Node:
         return cls(node)
 
     @classmethod
-    def get_root_node(cls, problem: Problem):
+    def get_root_node(cls, cg_solver: ColumnGenerationSolver | None):
         """
-        Creates the first root node, and initialises the column generation solver
+        Creates the first root node, with the column generation solver
+        shared by the whole tree.
+        `cg_solver` is None when the nodes are solved by worker processes,
+        each with its own column generation solver.
         No parent node, and no var fixings.
         """
         node = Node(None)
-        node._set_cg_solver(ColumnGenerationSolver(problem))
+        node._set_cg_solver(cg_solver)
         return node
 
 
@@ -109,90 +188,213 @@ class BranchAndPriceSolver:
 
     # Default parameters.
     # Should be a dictionary containing parameter -> value
-    DEFAULT_PARAMETERS = {}
+    #  - node_selection : how the next node is chosen, one of
+    #       "dfs" (depth-first), "bestfirst" (best bound first), or
+    #       "hybrid" (depth-first until an incumbent is found, then best bound first)
+    #  - num_workers : number of processes solving nodes in parallel (1 is serial)
+    DEFAULT_PARAMETERS = {"node_selection": "bestfirst", "num_workers": 1}
+    NODE_SELECTIONS = ["dfs", "bestfirst", "hybrid"]
 
-    def __init__(self, problem: Problem) -> None:
+    def __init__(self, problem: Problem, parameters: dict | None = None) -> None:
         """
-        Basic constructor of branch and price solver for a problem instance
+        Basic constructor of branch and price solver for a problem instance.
+        Any `parameters` given override the defaults.
         """
         # Problem instance to solve
         self.problem: Problem = problem
         # Grab the default parameter set
-        self.parameters = BranchAndPriceSolver.DEFAULT_PARAMETERS
+        self.parameters = dict(BranchAndPriceSolver.DEFAULT_PARAMETERS)
+        if parameters is not None:
+            self.parameters.update(parameters)
+        if self.parameters["node_selection"] not in self.NODE_SELECTIONS:
+            raise ValueError(
+                f"Node selection is not valid : {self.parameters['node_selection']}"
+            )
+        # See `Problem.sense_sign`
+        self._sense_sign: int = problem.sense_sign
         # Best solution and incumbent
         self.solution: Solution = None
         self._incumbent_solution: Solution = None
-        # List of nodes yet to explore
-        self._node_list: list[Node] = []
+        # Nodes yet to explore.
+        # A stack of nodes when depth-first, otherwise a heap of
+        # (priority, tiebreak, node) entries
+        self._node_list: list = []
+        self._best_first: bool = self.parameters["node_selection"] == "bestfirst"
+        self._node_counter = itertools.count()
 
     def solve(self):
         """
         Solves the problem instance using branch and price.
         """
-        # Add in the root node
-        self._node_list.append(Node.get_root_node(self.problem))
-
-        # While there are still nodes to explore
-        while len(self._node_list) > 0:
-            # Get the next node
-            node = self._get_next_node()
-
-            # Solve the node
-            node_bound, partial_solution = node.solve()
-
-            # Attempt to repair (if required)
-            repaired_solution = self._heuristic_repair(partial_solution)
-
-            # Did it manage to repair a solution?
-            if repaired_solution is not None:
-                # Is the incumbent still none?
-                if self._incumbent_solution is None:
-                    self._incumbent_solution = repaired_solution
-                # If not, is this new solution better?
-                elif (
-                    repaired_solution.objective_value
-                    > self._incumbent_solution.objective_value
-                ):
-                    # Improved solution found!
-                    self._incumbent_solution = repaired_solution
-
-            # Check if upper bound < lower bound
-            if (
-                node_bound < self._incumbent_solution.objective_value
-                and self.problem.sense == "max"
-            ) or (
-                node_bound > self._incumbent_solution.objective_value
-                and self.problem.sense == "min"
-            ):
-                # Bound failed!!
-                # Dont branch! Go straight to next node
-                continue
+        if self.parameters["num_workers"] > 1:
+            # Add in the root node.
+            # No column generation solver here, each worker builds its own
+            self._add_node(Node.get_root_node(None))
+            self._solve_parallel()
+        else:
+            # Column generation solver is closed once the tree is explored
+            with ColumnGenerationSolver(self.problem) as cg_solver:
+                # Add in the root node
+                self._add_node(Node.get_root_node(cg_solver))
+
+                # While there are still nodes to explore
+                while len(self._node_list) > 0:
+                    # Get the next node
+                    node = self._get_next_node()
+                    if self._can_prune(node):
+                        # Parent bound already fails, no need to solve
+                        continue
 
-            # Create branches
-            children = self._make_children(node, partial_solution)
-            if children is not None:
-                for child in children:
-                    self._node_list.append(child)
+                    # Solve the node
+                    node_bound, partial_solution = node.solve()
+                    self._process_node(node, node_bound, partial_solution)
 
         # Branch and bound complete
         self.solution = self._incumbent_solution
         return self.solution
 
+    def _solve_parallel(self):
+        """
+        Explores the tree with a pool of worker processes.
+        Each worker has its own column generation solver, and is sent only the
+        fixings of a node. This process keeps the node list and incumbent,
+        so nodes are pruned against the latest incumbent before being sent.
+        `_heuristic_repair` and `_make_children` run here, where nodes have no
+        column generation solver, so cannot see the extreme points of any RMP.
+        So the partial solution (`get_solution()` of the RMP) must be in terms of
+        the original variables, and so must the fixings, never blend variable
+        indices (which differ between workers).
+        """
+        num_workers = self.parameters["num_workers"]
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            initializer=_init_worker,
+            initargs=(self.problem,),
+        ) as executor:
+            running = {}
+            while len(self._node_list) > 0 or len(running) > 0:
+                # Keep all the workers busy
+                while len(self._node_list) > 0 and len(running) < num_workers:
+                    node = self._get_next_node()
+                    if self._can_prune(node):
+                        # Parent bound already fails, no need to solve
+                        continue
+                    running[executor.submit(_solve_fixings, node.get_fixings())] = node
+                if len(running) == 0:
+                    continue
+
+                # Process nodes as they finish
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    node_bound, partial_solution = future.result()
+                    self._process_node(node, node_bound, partial_solution)
+
+    def _process_node(self, node: Node, node_bound: float, partial_solution: Any):
+        """
+        Processes a solved node.
+        Updates the incumbent, then either prunes the node or branches on it.
+        """
+        node.set_bound(node_bound)
+        if node_bound is None:
+            # Node is infeasible
+            return
+
+        # Attempt to repair (if required)
+        repaired_solution = self._heuristic_repair(partial_solution)
+
+        # Did it manage to repair a solution?
+        if repaired_solution is not None:
+            # Is the incumbent still none?
+            if self._incumbent_solution is None:
+                self._incumbent_solution = repaired_solution
+            # If not, is this new solution better?
+            elif (
+                self._sense_sign * repaired_solution.objective_value
+                > self._sense_sign * self._incumbent_solution.objective_value
+            ):
+                # Improved solution found!
+                self._incumbent_solution = repaired_solution
+
+        # Check if upper bound < lower bound
+        if self._bound_fails(node_bound):
+            # Bound failed!!
+            # Dont branch! Go straight to next node
+            return
+
+        # Create branches
+        children = self._make_children(node, partial_solution)
+        if children is not None:
+            for child in children:
+                self._add_node(child)
+
+    def _can_prune(self, node: Node) -> bool:
+        """
+        Returns true if a node can be pruned before it is solved.
+        A child's bound can only be worse than its parent's,
+        so if the inherited parent bound fails, so will the child.
+        The incumbent may have improved since the node was added.
+        """
+        bound = node.get_bound()
+        return bound is not None and self._bound_fails(bound)
+
+    def _bound_fails(self, bound: float) -> bool:
+        """
+        Returns true if `bound` is worse than the incumbent.
+        """
+        if self._incumbent_solution is None:
+            return False
+        return (
+            self._sense_sign * bound
+            < self._sense_sign * self._incumbent_solution.objective_value
+        )
+
+    def _add_node(self, node: Node):
+        """
+        Adds a node to the list of nodes yet to explore.
+        """
+        if self._best_first:
+            heapq.heappush(self._node_list, self._node_entry(node))
+        else:
+            self._node_list.append(node)
+
     def _get_next_node(self) -> Node:
         """
         Gets the next node from the list, and removes it from the list
-        Suggestion is to use `self._node_list.pop(index)`.
-
-        For instance,
-         - `return self._node_list.pop(-1)` would get the last node (most recently added).
+        Depends on the `node_selection` parameter,
+         - "dfs" pops the last node (most recently added).
             This is equivalently **depth-first-search**.
-         - `return self._node_list.pop(0)` would get the first node.
-            This is equivalently **breadth-first-search**.
-        Alternatively, could scan each node for best bound / most promising
+         - "bestfirst" pops the node with the best bound.
+            Ties are broken towards the most recently added node.
+         - "hybrid" is depth-first until an incumbent is found,
+            then switches to best-first.
         """
-        # Use depth first as example...
+        if (
+            not self._best_first
+            and self.parameters["node_selection"] == "hybrid"
+            and self._incumbent_solution is not None
+        ):
+            # Incumbent found, switch over to best first
+            self._best_first = True
+            self._node_list = [self._node_entry(node) for node in self._node_list]
+            heapq.heapify(self._node_list)
+        if self._best_first:
+            return heapq.heappop(self._node_list)[-1]
         return self._node_list.pop(-1)
 
+    def _node_entry(self, node: Node) -> tuple[float, int, Node]:
+        """
+        Returns the heap entry of a node, as (priority, tiebreak, node).
+        Smallest priority is the best bound, so is negated for max problems.
+        Unsolved root node (no bound yet) is always first.
+        """
+        bound = node.get_bound()
+        if bound is None:
+            priority = float("-inf")
+        else:
+            priority = -self._sense_sign * bound
+        return priority, -next(self._node_counter), node
+
     def _heuristic_repair(self, partial_solution: Any) -> Solution | None:
         """
         Attempts to repair a partial solution.
@@ -213,9 +415,12 @@ class BranchAndPriceSolver:
         child1 = Node.create_child(parent_node)
         child2 = Node.create_child(parent_node)
 
-        # Now, base on `partial solution`, choose a branching variable
+        # Now, base on `partial solution`, find the fractional variables once.
+        # These are both the integrality check and the branching candidates,
+        # e.g. with numpy `np.flatnonzero((x > 1e-9) & (x < 1 - 1e-9))`.
+        # If there are no fractional, return None
+        # Otherwise, choose a branching variable from the fractional variables
         # Then carefully select which direction to branch first.
         # child1.add_fixed_var(var,val1)
         # child2.add_fixed_var(var,val2)
-        # If there are no fractional, return None
         return child1, child2
@@ -1,3 +1,6 @@
+import copy
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from problem import Problem
 from typing import Any
 
@@ -12,14 +15,32 @@ class SubProblem:
      - problem (Problem) : the particular problem instances
 
     Methods
-     - add_fixed_vars(fixings : list[tuple]) : Adds in the variable fixings provided.
-     - remove_fixed_vars(fixings : list[tuple]) : Removes all fixings, resets for next solve.
-     - solve(dual_values : Any) : Solves the subproblem for given dual variables.
+     - add_fixed_vars(fixings : tuple[tuple]) : Adds in the variable fixings provided.
+     - remove_fixed_vars(fixings : tuple[tuple]) : Removes all fixings, resets for next solve.
+     - solve(dual_values : Any) : Solves the subproblem for given dual variables,
+            returns a list of up to `MAX_SOLUTIONS` solutions.
     """
 
+    # Maximum number of solutions returned by each solve
+    MAX_SOLUTIONS = 10
+
+    # Attributes are read every CG iteration, so use slots rather than a `__dict__`.
+    # Any attributes added for an application must also be added here
+    __slots__ = ("problem", "_model")
+
     def __init__(self, problem: Problem):
-        """Basic subproblem constructor, only contains `problem` attribute"""
+        """Basic subproblem constructor, contains `problem` and the subproblem model"""
         self.problem = problem
+        # The subproblem model, built once and reused for every solve
+        self._model: Any = self._build_model()
+
+    def _build_model(self) -> Any:
+        """
+        Builds the subproblem model, i.e. variables and constraints.
+        Only the objective depends on the dual values, so this is only done once.
+        """
+        model: Any = None
+        return model
 
     def add_fixed_vars(self, fixings):
         """Add in the fixed variables as listed in `fixings`"""
@@ -29,22 +50,30 @@ class SubProblem:
         """Removes all fixed variables"""
         pass
 
-    def solve(self, dual_values) -> tuple[float | None, Any | None]:
+    def solve(self, dual_values) -> list[tuple[float, Any]]:
         """
         Solves the subproblem, for given fixed values (pre-provided) and given dual values.
+        Up to `MAX_SOLUTIONS` solutions can be returned, so that several extreme
+        points are added per RMP solve.
+        E.g., the best `MAX_SOLUTIONS` from a solution pool, or all ties (within
+        tolerance) found when backtracking a dynamic program.
+        The first solution must be optimal (exact pricing) whenever
+        `ColumnGenerationSolver._get_lagrangian_bound` is implemented,
+        since the bound is computed from it.
 
         Parameters
          - dual_values (Any) : The dual values from the restricted master problem.
             these link up with the subproblem to generate new extreme points
 
-        Returns
+        Returns a list of (obj_value, solution), best solution first (top-k)
          - obj_value (float) : objective value of the solution
-        If problem infeasible, returns None,None
          - solution (Any) : Solution of the SP, to be used as a new extreme point
+        If problem infeasible, returns an empty list
         """
-        obj_val: float | None = None
-        solution: Any | None = None
-        return obj_val, solution
+        # Update the objective coefficients of `self._model` to `dual_values`
+        # (rather than rebuilding the objective expression), then solve
+        solutions: list[tuple[float, Any]] = []
+        return solutions
 
 
 class RestrictedMasterProblem:
@@ -56,40 +85,182 @@ class RestrictedMasterProblem:
 
     Attributes
      - extreme_points (list) : A list of extreme points
+     - extreme_point_sp_indices (list[int]) : The subproblem of each extreme point
      - problem (Problem) : problem instance
 
     Methods
-     - add_extreme_point(x) : add's `x` to the list of extreme points, and adds another
-            blend variable to the RMP formulation.
-     - add_fixed_vars(fixings : list[tuple]) : Adds in the variable fixings provided.
-     - remove_fixed_vars(fixings : list[tuple]) : Removes all fixings, resets for next solve.
-     - solve() : Solves the RMP.
+     - add_extreme_point(x, sp_index) : add's `x` (from subproblem `sp_index`) to the
+            list of extreme points, and adds another blend variable to the RMP formulation.
+     - add_extreme_points(points) : same as `add_extreme_point`, for a batch of
+            (sp_index, x) points.
+     - has_extreme_point(x, sp_index) : returns true if `x` is already an extreme point
+            of subproblem `sp_index`.
+     - add_fixed_vars(fixings : tuple[tuple]) : Adds in the variable fixings provided.
+     - remove_fixed_vars(fixings : tuple[tuple]) : Removes all fixings, resets for next solve.
+     - solve() : Solves the RMP, warm started from the basis of the last solve.
      - get_dual_values() : returns the dual values that can then be used by the subproblem solver.
-     - get_reduced_costs() : returns the reduced cost of the current blend.
+     - get_reduced_cost(sp_index) : returns the reduced cost of the current blend,
+            for subproblem `sp_index`.
+     - get_extreme_point_reduced_cost(x, sp_index) : returns the reduced cost of the
+            blend variable of `x`, at the dual values of the last solve.
     """
 
+    # Slots, as for `SubProblem`, so add any application attributes here too
+    __slots__ = (
+        "problem",
+        "extreme_points",
+        "extreme_point_sp_indices",
+        "_extreme_point_keys",
+        "solution",
+        "_fixings_stack",
+        "_basis",
+        "_dual_values",
+        "_model",
+    )
+
     def __init__(self, problem: Problem):
         self.problem = problem
-        self.extreme_point = []
+        self.extreme_points = []
+        # The subproblem each extreme point came from
+        self.extreme_point_sp_indices: list[int] = []
+        # Hashable (sp_index, key) of the extreme points, to detect duplicates.
+        # The same point from two different subproblems is two different columns
+        self._extreme_point_keys: set = set()
         self.solution = None
+        # Fixed variables and their bounds before fixing, in the order fixed
+        self._fixings_stack: list[tuple] = []
+        # Basis of the last solve, used to warm start the next solve
+        self._basis: Any = None
+        # Buffer of the dual values, allocated once (e.g. `np.empty(n)`)
+        # and filled in place after each solve
+        self._dual_values: Any = None
+        # The RMP model, built once with no columns
+        self._model: Any = self._build_model()
+
+    def _build_model(self) -> Any:
+        """
+        Builds the RMP model, i.e. the objective sense and the rows (constraints),
+        but with no columns.
+        Blend dvars are then only ever added as columns by `add_extreme_point`,
+        so no dummy variables or expressions are needed to set up the rows.
+        """
+        model: Any = None
+        return model
 
-    def add_extreme_point(self, x):
-        """Adds a new extreme point to the formulation, and to the RMP formulation"""
-        # Add point to list
-        self.extreme_point.append(x)
-        # Add in a new blend dvar lambda to the RMP formulation
-        pass
+    def add_extreme_point(self, x, sp_index: int = 0):
+        """
+        Adds a new extreme point of subproblem `sp_index` to the formulation,
+        and to the RMP formulation
+        """
+        self.add_extreme_points([(sp_index, x)])
+
+    def add_extreme_points(self, points: list[tuple[int, Any]]) -> int:
+        """
+        Adds new extreme points, as (sp_index, x), to the formulation,
+        and to the RMP formulation.
+        Any that are already extreme points of their subproblem
+        (or repeated in `points`) are skipped.
+        Returns the number of extreme points added.
+        """
+        new_points = []
+        for sp_index, x in points:
+            key = (sp_index, self._get_extreme_point_key(x))
+            if key in self._extreme_point_keys:
+                continue
+            self._extreme_point_keys.add(key)
+            new_points.append((sp_index, x))
+        # Add points to list
+        for sp_index, x in new_points:
+            self.extreme_points.append(x)
+            self.extreme_point_sp_indices.append(sp_index)
+        # Add in a new blend dvar lambda for each point to the RMP formulation
+        # Add them all in a single call (one batch of columns),
+        # each column from the non-zeros in `self._get_column(x, sp_index)`,
+        # rather than rebuilding each constraint and the objective expression.
+        # They should enter non-basic (at their lower bound of 0),
+        # so the basis of the last solve is still a valid starting basis
+        return len(new_points)
+
+    def has_extreme_point(self, x, sp_index: int = 0) -> bool:
+        """Returns true if `x` is already an extreme point of subproblem `sp_index`"""
+        key = (sp_index, self._get_extreme_point_key(x))
+        return key in self._extreme_point_keys
+
+    def _get_extreme_point_key(self, x):
+        """
+        Returns a hashable key of extreme point `x`.
+        Depends on how extreme points are stored, e.g. `x.tobytes()` for numpy arrays.
+        """
+        return x
+
+    def _get_column(self, x, sp_index: int = 0) -> list[tuple[int, float]]:
+        """
+        Returns the column of the blend dvar for extreme point `x` of subproblem
+        `sp_index`, as (constraint index, coefficient) pairs of the non-zero
+        coefficients only.
+        Including the convexity constraint of subproblem `sp_index` (if any).
+        """
+        column: list[tuple[int, float]] = []
+        return column
+
+    def _get_objective_coefficient(self, x, sp_index: int = 0) -> float:
+        """
+        Returns the objective coefficient of the blend dvar for extreme point `x`
+        of subproblem `sp_index`.
+        """
+        coefficient: float = 0.0
+        return coefficient
+
+    def get_extreme_point_reduced_cost(self, x, sp_index: int = 0) -> float:
+        """
+        Returns the reduced cost of the blend dvar for extreme point `x` of subproblem
+        `sp_index`, at the dual values of the last solve.
+        """
+        dual_values = self.get_dual_values()
+        return self._get_objective_coefficient(x, sp_index) - sum(
+            dual_values[row] * coefficient
+            for row, coefficient in self._get_column(x, sp_index)
+        )
 
     def add_fixed_vars(self, fixings):
-        """Add in the fixed variables as listed in `fixings`"""
-        pass
+        """
+        Add in the fixed variables as listed in `fixings`.
+        Fixings are only bound changes on `self._model` (never a rebuild),
+        so the basis of the last solve stays a valid start for dual simplex.
+        """
+        for var, val in fixings:
+            # Get the current bounds of the variable(s) that `var` fixes
+            old_bounds: Any = None
+            self._fixings_stack.append((var, old_bounds))
+            # Then tighten the bounds to fix `var` to `val`
+            pass
 
     def remove_fixed_vars(self):
-        """Removes all fixed variables"""
-        pass
+        """Removes all fixed variables, restoring their bounds in reverse order"""
+        while len(self._fixings_stack) > 0:
+            var, old_bounds = self._fixings_stack.pop()
+            # Restore the bounds of `var` to `old_bounds`
+            pass
 
     def solve(self):
-        """Solve the RMP LP"""
+        """
+        Solve the RMP LP.
+        Between solves only a new column or the fixings change, so the solve is
+        warm started from the basis of the last solve (if there is one).
+        """
+        if self._basis is None:
+            # First solve of `self._model`, from scratch
+            pass
+        else:
+            # Resolve `self._model` (never rebuild it), and set `self._basis` as
+            # the starting basis.
+            # Use (serial) dual simplex, and turn off presolve,
+            # since either can discard or invalidate the starting basis
+            pass
+        # Then store the optimal basis in `self._basis` for the next solve
+        pass
+        # And fill the dual values buffer `self._dual_values` in place from the
+        # solver (allocating it on the first solve only)
         pass
 
     def is_feasible(self) -> bool:
@@ -105,57 +276,284 @@ class RestrictedMasterProblem:
         pass
 
     def get_dual_values(self):
-        """Gets the dual values list of size n"""
-        dual_values: Any = None
-        return dual_values
+        """
+        Gets the dual values list of size n.
+        Returns the `self._dual_values` buffer filled by the last solve,
+        without copying.
+        Callers must not modify it, and it is overwritten by the next solve.
+        """
+        return self._dual_values
 
-    def get_reduced_cost(self):
-        """Gets the reduced cost of last solve"""
+    def get_reduced_cost(self, sp_index: int = 0):
+        """
+        Gets the reduced cost of last solve, for subproblem `sp_index`.
+        E.g. the dual of its convexity constraint, when each subproblem (block)
+        has its own.
+        """
         reduced_cost: Any = None
         return reduced_cost
 
 
 class ColumnGenerationSolver:
+    # Safety limit, CG should normally stop on convergence or the bound gap below
     MAX_ITERATION = 250
+    # Relative gap between the RMP objective and Lagrangian bound to stop at
+    GAP_TOLERANCE = 1e-4
+    # Stop as tailing off if the gap closes by less than `TAILING_OFF_IMPROVEMENT`
+    # (relative) over the last `TAILING_OFF_ITERATIONS` iterations
+    TAILING_OFF_ITERATIONS = 20
+    TAILING_OFF_IMPROVEMENT = 0.01
+    # Reduced cost tolerance for an extreme point to improve the RMP
+    TOLERANCE = 1e-6
+    # Dual smoothing factor (Wentges), in [0, 1). 0 turns smoothing off.
+    # Subproblems are priced at `a * center + (1 - a) * duals`, where the center is
+    # the dual values with the best Lagrangian bound so far.
+    # Needs `_get_lagrangian_bound` (no bound, no center, so no smoothing),
+    # and dual values that support arithmetic (e.g. numpy arrays)
+    DUAL_SMOOTHING = 0.0
+    # Number of most recent solves kept, to reuse for the same set of fixings.
+    # Off by default, since branching whose children partition their parent never
+    # repeats a set of fixings. Only useful when it can (e.g. symmetric branching)
+    SOLVE_CACHE_SIZE = 0
+    # Solve the subproblems in parallel threads (when there is more than one).
+    # Only useful when the subproblem solver releases the GIL
+    SOLVE_SUBPROBLEMS_PARALLEL = True
 
     def __init__(self, problem: Problem):
         self.problem = problem
-        self.sp = SubProblem(problem)
+        self.sps: list[SubProblem] = self._create_subproblems(problem)
+        # Thread pool for the subproblems, created when first needed.
+        # Shut down by `close()`
+        self._executor: ThreadPoolExecutor | None = None
         self.rmp = RestrictedMasterProblem(problem)
+        # See `Problem.sense_sign`
+        self._sense_sign: int = problem.sense_sign
+        # Results of the most recent solves (least recent first),
+        # keyed by the set of fixings
+        self._solve_cache: OrderedDict[frozenset, tuple] = OrderedDict()
+
+    def __enter__(self) -> "ColumnGenerationSolver":
+        return self
 
-    def solve(self, fixings):
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self):
+        """Shuts down the subproblem thread pool (if any)"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def solve(self, fixings: tuple):
+        """
+        Solves the LP relaxation for the given tuple of variable fixings.
+        The same set of fixings in any order (e.g. from symmetric branching)
+        reuses one of the last `SOLVE_CACHE_SIZE` solves.
+        Fixings that are not hashable are always solved, and never cached.
+        """
+        if self.SOLVE_CACHE_SIZE <= 0:
+            return self._solve(fixings)
+        try:
+            key = frozenset(fixings)
+        except TypeError:
+            return self._solve(fixings)
+        if key in self._solve_cache:
+            self._solve_cache.move_to_end(key)
+            return self._solve_cache[key]
+        result = self._solve(fixings)
+        self._solve_cache[key] = result
+        if len(self._solve_cache) > self.SOLVE_CACHE_SIZE:
+            self._solve_cache.popitem(last=False)
+        return result
+
+    def _solve(self, fixings: tuple):
+        """
+        Runs column generation for the given tuple of variable fixings.
+        The fixings are always removed afterwards, however the solve ends,
+        so the next node starts from a clean RMP and subproblem.
+        """
         self._add_fixed_vars(fixings)
-        iteration = 0
-        while iteration < self.MAX_ITERATION:
+        try:
+            return self._column_generation()
+        finally:
+            self._remove_fixed_vars()
+
+    def _column_generation(self):
+        """Runs the column generation loop, with the fixings already added"""
+        # Hoist lookups out of the loop
+        rmp = self.rmp
+        solve_subproblems = self._solve_subproblems
+        get_lagrangian_bound = self._get_lagrangian_bound
+        sense_sign = self._sense_sign
+        tolerance = self.TOLERANCE
+        smoothing = self.DUAL_SMOOTHING
+        # Stability center of the dual smoothing, as (dual values, reduced costs)
+        dual_center = None
+        # Best Lagrangian bound, and the recent gaps to it
+        best_bound = None
+        gap_history = deque(maxlen=self.TAILING_OFF_ITERATIONS)
+
+        def price(dual_values, reduced_costs) -> tuple[list, list]:
+            # Returns the extreme points, as (sp_index, ep), that can improve the RMP
+            # (checked before adding), and the best (signed) reduced cost of each
+            # subproblem (None if infeasible)
+            points = []
+            best_reduced_costs = []
+            for sp_index, solutions in enumerate(solve_subproblems(dual_values)):
+                reduced_cost = reduced_costs[sp_index]
+                best_reduced_cost = None
+                for sp_objval, ep in solutions:
+                    signed_reduced_cost = sense_sign * (sp_objval - reduced_cost)
+                    if signed_reduced_cost > tolerance:
+                        points.append((sp_index, ep))
+                    if (
+                        best_reduced_cost is None
+                        or signed_reduced_cost > best_reduced_cost
+                    ):
+                        best_reduced_cost = signed_reduced_cost
+                best_reduced_costs.append(best_reduced_cost)
+            return points, best_reduced_costs
+
+        def improves(bound) -> bool:
+            # Returns true if `bound` is tighter than the best Lagrangian bound
+            return bound is not None and (
+                best_bound is None or sense_sign * bound < sense_sign * best_bound
+            )
+
+        for _ in range(self.MAX_ITERATION):
             # Solve RMP
-            iteration += 1
-            self.rmp.solve()
+            rmp.solve()
 
             # Check feasibility (fixed values may make it infeasible)
-            if not self.rmp.is_feasible():
+            if not rmp.is_feasible():
                 return None, None
 
             # Get dual values
-            dual_values = self.rmp.get_dual_values()
-            reduced_cost = self.rmp.get_reduced_cost()
-
-            # Generate extreme point
-            ep, sp_objval = self.sp.solve(dual_values)
-            self.rmp.add_extreme_point(ep)
+            dual_values = rmp.get_dual_values()
+            reduced_costs = [rmp.get_reduced_cost(k) for k in range(len(self.sps))]
+
+            # Generate extreme points, and add them all in one batch.
+            # A duplicate extreme point cannot improve the duals (degenerate cycling),
+            # so is also skipped by the RMP.
+            num_added = 0
+            if smoothing > 0 and dual_center is not None:
+                # Price at the separation point, between the center and RMP duals.
+                # The reduced costs are duals too (e.g. of convexity constraints),
+                # so are smoothed the same way
+                center_duals, center_reduced_costs = dual_center
+                sep_duals = smoothing * center_duals + (1 - smoothing) * dual_values
+                sep_reduced_costs = [
+                    smoothing * center + (1 - smoothing) * reduced_cost
+                    for center, reduced_cost in zip(center_reduced_costs, reduced_costs)
+                ]
+                points, best_reduced_costs = price(sep_duals, sep_reduced_costs)
+                # Only add those that also improve at the RMP dual values
+                num_added = rmp.add_extreme_points(
+                    [
+                        (sp_index, ep)
+                        for sp_index, ep in points
+                        if sense_sign * rmp.get_extreme_point_reduced_cost(ep, sp_index)
+                        > tolerance
+                    ]
+                )
+                # Move the center only if the separation point improves the bound
+                bound = get_lagrangian_bound(sep_duals, best_reduced_costs)
+                if improves(bound):
+                    best_bound = bound
+                    dual_center = (sep_duals, sep_reduced_costs)
+            if num_added == 0:
+                # Mispricing (or not smoothing), price at the RMP dual values.
+                # Only converged if these give no extreme points either.
+                points, best_reduced_costs = price(dual_values, reduced_costs)
+                num_added = rmp.add_extreme_points(points)
+                bound = get_lagrangian_bound(dual_values, best_reduced_costs)
+                if improves(bound):
+                    best_bound = bound
+                    if smoothing > 0:
+                        # Copied, since the RMP reuses its dual values buffer
+                        dual_center = (copy.copy(dual_values), list(reduced_costs))
 
             # Check stopping criteria
-            if (sp_objval - reduced_cost <= 1e-6 and self.problem.sense == "max") or (
-                sp_objval - reduced_cost >= 1e-6 and self.problem.sense == "min"
+            # No improving extreme points (or infeasible subproblem)
+            if num_added == 0:
+                return rmp.get_objective_value(), rmp.get_solution()
+
+            # Lagrangian bound gap
+            if best_bound is None:
+                continue
+            objective_value = rmp.get_objective_value()
+            gap = sense_sign * (best_bound - objective_value)
+            # Bound gap closed
+            if gap <= self.GAP_TOLERANCE * max(abs(objective_value), 1):
+                return best_bound, rmp.get_solution()
+            # Tailing off, the gap has barely closed in the last iterations
+            gap_history.append(gap)
+            if (
+                len(gap_history) == gap_history.maxlen
+                and gap_history[0] - gap < self.TAILING_OFF_IMPROVEMENT * gap_history[0]
             ):
-                return self.rmp.get_objective_value(), self.rmp.get_solution()
-        self._remove_fixed_vars()
+                return best_bound, rmp.get_solution()
+
+        # Iteration limit reached, return the last RMP solve.
+        # The RMP objective is not a valid bound yet, so use the Lagrangian bound
+        if best_bound is not None:
+            return best_bound, rmp.get_solution()
+        return rmp.get_objective_value(), rmp.get_solution()
+
+    def _get_lagrangian_bound(
+        self, dual_values, best_reduced_costs: list[float | None]
+    ) -> float | None:
+        """
+        Returns the Lagrangian bound on the LP relaxation at `dual_values`, from the
+        best (signed) reduced cost of each subproblem priced at them
+        (None if that subproblem is infeasible).
+        For instance, `b @ dual_values + sum(K_k * best_reduced_costs[k])`
+        (or minus, if minimising) when the blend variables of subproblem `k`
+        sum to at most `K_k`.
+        At the RMP dual values `b @ dual_values` is the RMP objective value,
+        giving the Lasdon bound.
+        Only a valid bound if every subproblem was solved to optimality (exact
+        pricing), i.e. its first solution is optimal.
+        It is returned as the node bound (and so used for pruning) when CG stops
+        on the gap, tailing off or the iteration limit, and moves the smoothing
+        center. So with heuristic pricing, return None.
+        Depends on the application, returns None if no such bound is known.
+        """
+        return None
+
+    def _create_subproblems(self, problem: Problem) -> list[SubProblem]:
+        """
+        Creates the subproblems.
+        Many applications have a single subproblem, but some decompose into
+        several independent subproblems (e.g. one per block).
+        """
+        return [SubProblem(problem)]
+
+    def _solve_subproblems(self, dual_values) -> list[list[tuple[float, Any]]]:
+        """
+        Solves all subproblems for the given dual values,
+        and returns the list of solutions of each subproblem (in order of `self.sps`).
+        The subproblems only share the (read only) dual values,
+        so can be solved in parallel.
+        """
+        if self.SOLVE_SUBPROBLEMS_PARALLEL and len(self.sps) > 1:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=len(self.sps))
+            sps_solutions = self._executor.map(
+                lambda sp: sp.solve(dual_values), self.sps
+            )
+        else:
+            sps_solutions = (sp.solve(dual_values) for sp in self.sps)
+        return list(sps_solutions)
 
     def _add_fixed_vars(self, fixings):
         """Add in the fixed variables as listed in `fixings`"""
         self.rmp.add_fixed_vars(fixings)
-        self.sp.add_fixed_vars(fixings)
+        for sp in self.sps:
+            sp.add_fixed_vars(fixings)
 
     def _remove_fixed_vars(self):
         """Removes all fixed variables"""
         self.rmp.remove_fixed_vars()
-        self.sp.remove_fixed_vars()
+        for sp in self.sps:
+            sp.remove_fixed_vars()
@@ -9,6 +9,7 @@ class Problem:
     This includes parameters, sets, coefficients, constraints etc.
     Once created, the Solver class should not modify anything in here.
     Should also contain a *sense*, which is whether the problem is a max or min problem.
+    The solvers use it as `sense_sign` (+1 for max, -1 for min).
     Particular implementation of this class depends on specific application.
     """
 
@@ -21,6 +22,18 @@ class Problem:
         if self.sense not in ["max", "min"]:
             raise TypeError(f"Problem sense is not valid : {self.sense}")
 
+    @property
+    def sense_sign(self) -> int:
+        """
+        Sense as a sign, +1 if maximisation or -1 if minimisation,
+        so that larger signed objective values are better.
+        Always read from `sense`, so stays correct if `sense` is set after `__init__`.
+        Solvers read this once when built, not in their hot loops.
+        """
+        if self.sense not in ["max", "min"]:
+            raise TypeError(f"Problem sense is not valid : {self.sense}")
+        return 1 if self.sense == "max" else -1
+
     @classmethod
     def example_generator(cls) -> Problem:
         """